@@ -1,6 +1,10 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
 from datetime import datetime
 
 # Nombre de la base de datos.
@@ -16,6 +20,9 @@ st.set_page_config(
 # Lista de departamentos disponibles
 DEPARTAMENTOS = ["Logística", "Almacén", "Ático", "Laboratorio", "Oficina", "Taller"]
 
+# Versión de las reglas de normalizar_nombre; al cambiarlas se recalculan las claves
+VERSION_NORMALIZACION = 1
+
 # --- Funciones de la Base de Datos ---
 
 @st.cache_resource
@@ -33,6 +40,7 @@ def init_db(conn):
         CREATE TABLE IF NOT EXISTS productos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nombre TEXT NOT NULL,
+            nombre_normalizado TEXT,
             cantidad INTEGER,
             unidad_medida TEXT,
             departamento TEXT,
@@ -58,18 +66,100 @@ def init_db(conn):
         )
     ''')
     
+    # Migración: bases de datos creadas antes de existir nombre_normalizado
+    columnas = [col[1] for col in c.execute("PRAGMA table_info(productos)")]
+    if 'nombre_normalizado' not in columnas:
+        c.execute("ALTER TABLE productos ADD COLUMN nombre_normalizado TEXT")
+    
+    # Rellenar la clave normalizada de los productos que aún no la tienen, o
+    # de todos si las reglas de normalización cambiaron desde la última vez
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version < VERSION_NORMALIZACION:
+        pendientes = c.execute("SELECT id, nombre FROM productos").fetchall()
+        c.execute(f"PRAGMA user_version = {VERSION_NORMALIZACION}")
+    else:
+        pendientes = c.execute(
+            "SELECT id, nombre FROM productos WHERE nombre_normalizado IS NULL"
+        ).fetchall()
+    if pendientes:
+        c.executemany(
+            "UPDATE productos SET nombre_normalizado = ? WHERE id = ?",
+            [(normalizar_nombre(nombre), product_id) for product_id, nombre in pendientes]
+        )
+    
+    # Índice para la comprobación de duplicados al añadir (búsqueda O(log n)),
+    # con la misma clave que usa buscar_duplicados para formar sus bloques
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_productos_duplicados
+        ON productos (nombre_normalizado, departamento, unidad_medida)
+    ''')
+    
     conn.commit()
 
+def _singularizar(palabra):
+    """Reduce una palabra a una raíz común para singular y plural."""
+    if not palabra.isalpha():
+        return palabra
+    
+    raiz = palabra
+    if len(palabra) > 3:
+        # Quitar "es" (motores -> motor) o "s" (tornillos -> tornillo), sin
+        # dejar nunca menos de 3 letras: "pies" -> "pie", no "pi"
+        if palabra.endswith("es") and len(palabra) > 4:
+            raiz = palabra[:-2]
+        elif palabra.endswith("s"):
+            raiz = palabra[:-1]
+        
+        # "llave" y "llaves" deben dar la misma clave
+        if len(raiz) > 3 and raiz.endswith("e"):
+            raiz = raiz[:-1]
+    
+    # "lápiz" y "lápices", "dulce" y "dulces" terminan en la misma "c"
+    if raiz.endswith("z"):
+        raiz = raiz[:-1] + "c"
+    return raiz
+
+def normalizar_nombre(nombre):
+    """Genera la clave normalizada de un nombre de producto.
+    
+    Elimina acentos, mayúsculas, signos de puntuación, espacios sobrantes y
+    plurales, de modo que "Tornillo M6", "tornillo m6 " y "Tornillos M6"
+    comparten la misma clave. La ñ se conserva: "Caña" no es "Cana".
+    """
+    texto = unicodedata.normalize("NFKD", (nombre or "").casefold())
+    texto = "".join(
+        ch for i, ch in enumerate(texto)
+        if not unicodedata.combining(ch) or (ch == "\u0303" and texto[i - 1:i] == "n")
+    )
+    texto = unicodedata.normalize("NFC", texto)
+    texto = re.sub(r"[^\w]+", " ", texto)
+    return " ".join(_singularizar(palabra) for palabra in texto.split())
+
 def add_product(conn, nombre, cantidad, unidad_medida, departamento):
     """Inserta un nuevo producto y retorna su ID."""
     c = conn.cursor()
     c.execute("""
-        INSERT INTO productos (nombre, cantidad, unidad_medida, departamento) 
-        VALUES (?, ?, ?, ?)
-    """, (nombre, cantidad, unidad_medida, departamento))
+        INSERT INTO productos (nombre, nombre_normalizado, cantidad, unidad_medida, departamento) 
+        VALUES (?, ?, ?, ?, ?)
+    """, (nombre, normalizar_nombre(nombre), cantidad, unidad_medida, departamento))
     conn.commit()
     return c.lastrowid
 
+def buscar_duplicado(conn, nombre, departamento, unidad_medida):
+    """Busca un producto con el mismo nombre normalizado, departamento y unidad.
+    
+    Usa el índice sobre (nombre_normalizado, departamento, unidad_medida), por
+    lo que la búsqueda es O(log n). Retorna (id, nombre, cantidad) o None.
+    """
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, nombre, cantidad
+        FROM productos
+        WHERE nombre_normalizado = ? AND departamento = ? AND unidad_medida = ?
+        LIMIT 1
+    """, (normalizar_nombre(nombre), departamento, unidad_medida))
+    return c.fetchone()
+
 def update_product(conn, product_id, cantidad=None, departamento=None):
     """Actualiza un producto existente."""
     c = conn.cursor()
@@ -219,6 +309,197 @@ def get_departamento_stats(conn):
     df = pd.read_sql_query(query, conn)
     return df
 
+def _trigramas(texto):
+    """Conjunto de trigramas de un texto, con relleno en los extremos."""
+    texto = f"  {texto} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _raiz(padre, nodo):
+    """Raíz de un nodo en una estructura de unión-búsqueda guardada en un dict."""
+    while padre.get(nodo, nodo) != nodo:
+        padre[nodo] = padre.get(padre[nodo], padre[nodo])
+        nodo = padre[nodo]
+    return nodo
+
+def _jaccard(a, b):
+    """Similitud de Jaccard entre dos conjuntos no vacíos."""
+    comunes = len(a & b)
+    return comunes / (len(a) + len(b) - comunes)
+
+def _buscar_similares(nombres, umbral, trigramas):
+    """Pares de nombres cuya similitud de Jaccard sobre trigramas es >= umbral.
+    
+    trigramas asocia cada nombre con su conjunto de trigramas. Los bloques
+    pequeños se comparan par a par; en los grandes se usa filtrado por
+    prefijo: con los trigramas de cada nombre ordenados del menos al más
+    frecuente, dos nombres similares comparten al menos un trigrama de sus
+    prefijos, así que solo se comparan los pares que coinciden en el índice
+    invertido de prefijos y no todos contra todos.
+    """
+    if len(nombres) <= 10:
+        return [
+            (nombre, otro)
+            for i, nombre in enumerate(nombres)
+            for otro in nombres[i + 1:]
+            if _jaccard(trigramas[nombre], trigramas[otro]) >= umbral
+        ]
+    
+    frecuencia = Counter(t for nombre in nombres for t in trigramas[nombre])
+    
+    pares = []
+    indice = defaultdict(list)
+    for nombre in sorted(nombres, key=lambda n: len(trigramas[n])):
+        conjunto = trigramas[nombre]
+        tam = len(conjunto)
+        minimo = umbral * tam
+        ordenados = sorted(conjunto, key=lambda t: (frecuencia[t], t))
+        prefijo = ordenados[:tam - math.ceil(umbral * tam - 1e-9) + 1]
+        
+        candidatos = set()
+        for t in prefijo:
+            candidatos.update(indice[t])
+        
+        for otro in candidatos:
+            otro_conjunto = trigramas[otro]
+            if len(otro_conjunto) >= minimo and _jaccard(conjunto, otro_conjunto) >= umbral:
+                pares.append((nombre, otro))
+        
+        for t in prefijo:
+            indice[t].append(nombre)
+    
+    return pares
+
+def _claves_bloqueo(nombre_normalizado):
+    """Claves de bloqueo de un nombre normalizado.
+    
+    Un nombre entra en el bloque de sus palabras ordenadas y en el de cada
+    combinación que resulta de quitarle una palabra, así que dos nombres que
+    solo difieren en una palabra (una errata, una palabra de más o el orden)
+    siempre coinciden en algún bloque. Los nombres de una sola palabra se
+    bloquean por sus tres primeras y sus tres últimas letras.
+    """
+    palabras = sorted(nombre_normalizado.split())
+    if len(palabras) <= 1:
+        palabra = palabras[0] if palabras else ""
+        return [palabra, "^" + palabra[:3], palabra[-3:] + "$"]
+    
+    claves = {" ".join(palabras)}
+    for i in range(len(palabras)):
+        claves.add(" ".join(palabras[:i] + palabras[i + 1:]))
+    return list(claves)
+
+def buscar_duplicados(conn, umbral=0.7, progreso=None):
+    """Busca productos duplicados o casi duplicados en todo el inventario.
+    
+    Los productos se bloquean por departamento, unidad de medida y números del
+    nombre ("Tornillo M6" no es "Tornillo M8"), de modo que solo se comparan
+    productos que podrían fusionarse. Cada bloque se divide además según
+    _claves_bloqueo, de modo que su tamaño depende del vocabulario y no del
+    tamaño del inventario, y dentro de cada uno se agrupan los nombres por
+    similitud de trigramas. No se detectan pares que difieran en más de una
+    palabra. Los nombres normalizados idénticos siempre quedan juntos.
+    
+    progreso, si se indica, se llama con la fracción completada (0 a 1).
+    Retorna una lista de grupos, cada uno una lista de IDs ordenada.
+    """
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, nombre_normalizado, departamento, unidad_medida
+        FROM productos
+    """)
+    
+    ids_por_nombre = defaultdict(list)
+    bloques = defaultdict(list)
+    trigramas = {}
+    for product_id, nombre_normalizado, departamento, unidad_medida in c:
+        nombre_normalizado = nombre_normalizado or ""
+        cifras = tuple(re.findall(r"\d+", nombre_normalizado))
+        nodo = (departamento, unidad_medida, cifras, nombre_normalizado)
+        if nodo not in ids_por_nombre:
+            for clave in _claves_bloqueo(nombre_normalizado):
+                bloques[(departamento, unidad_medida, cifras, clave)].append(nombre_normalizado)
+            if nombre_normalizado not in trigramas:
+                trigramas[nombre_normalizado] = _trigramas(nombre_normalizado)
+        ids_por_nombre[nodo].append(product_id)
+    
+    # Unión-búsqueda entre bloques: un nombre puede unirse desde varios bloques
+    padre = {}
+    paso = max(1, len(bloques) // 100)
+    for n, ((departamento, unidad_medida, cifras, _), nombres) in enumerate(bloques.items()):
+        if len(nombres) > 1:
+            for nombre, otro in _buscar_similares(nombres, umbral, trigramas):
+                raiz_nombre = _raiz(padre, (departamento, unidad_medida, cifras, nombre))
+                raiz_otro = _raiz(padre, (departamento, unidad_medida, cifras, otro))
+                if raiz_nombre != raiz_otro:
+                    padre[raiz_otro] = raiz_nombre
+        if progreso and n % paso == 0:
+            progreso(n / len(bloques))
+    
+    grupos = defaultdict(list)
+    for nodo, ids in ids_por_nombre.items():
+        grupos[_raiz(padre, nodo)].extend(ids)
+    
+    if progreso:
+        progreso(1.0)
+    return [sorted(ids) for ids in grupos.values() if len(ids) > 1]
+
+def fusionar_productos(conn, id_destino, ids_origen):
+    """Fusiona varios productos en uno.
+    
+    Suma el stock de los productos origen al destino, traslada su historial
+    al destino y elimina los productos origen. Retorna la cantidad final.
+    """
+    c = conn.cursor()
+    
+    c.execute("SELECT cantidad, departamento FROM productos WHERE id = ?", (id_destino,))
+    destino = c.fetchone()
+    if not destino:
+        return None
+    
+    cantidad_destino, depto_destino = destino
+    cantidad_destino = cantidad_destino or 0
+    
+    ids_origen = [i for i in ids_origen if i != id_destino]
+    if not ids_origen:
+        return cantidad_destino
+    
+    marcadores = ", ".join("?" for _ in ids_origen)
+    c.execute(
+        f"SELECT id, nombre, cantidad, departamento FROM productos WHERE id IN ({marcadores})",
+        ids_origen
+    )
+    origenes = c.fetchall()
+    
+    cantidad_final = cantidad_destino + sum(cantidad or 0 for _, _, cantidad, _ in origenes)
+    c.execute("""
+        UPDATE productos SET cantidad = ?, fecha_actualizacion = CURRENT_TIMESTAMP
+        WHERE id = ?
+    """, (cantidad_final, id_destino))
+    c.execute(
+        f"UPDATE historial_movimientos SET producto_id = ? WHERE producto_id IN ({marcadores})",
+        [id_destino] + ids_origen
+    )
+    c.execute(f"DELETE FROM productos WHERE id IN ({marcadores})", ids_origen)
+    
+    # Registrar en historial una fusión por cada producto absorbido
+    acumulado = cantidad_destino
+    for _, nombre, cantidad, departamento in origenes:
+        registrar_movimiento(
+            conn,
+            id_destino,
+            nombre,
+            "FUSION",
+            acumulado,
+            acumulado + (cantidad or 0),
+            departamento,
+            depto_destino,
+            "Sistema"
+        )
+        acumulado += cantidad or 0
+    
+    conn.commit()
+    return cantidad_final
+
 # --- Configuración de la Aplicación Streamlit ---
 
 conn = get_connection()
@@ -306,9 +587,21 @@ if submitted:
             if not departamento:
                 st.error("⚠️ Debes seleccionar un departamento.")
             else:
-                product_id = add_product(conn, nombre.strip(), cantidad, unidad, departamento)
-                st.success(f"✅ Producto '{nombre}' añadido con éxito al departamento {departamento} (ID: {product_id}).")
-                st.rerun()
+                duplicado = buscar_duplicado(conn, nombre, departamento, unidad)
+                if duplicado:
+                    # Guardar el producto pendiente para que el usuario confirme
+                    st.session_state["producto_pendiente"] = {
+                        "nombre": nombre.strip(),
+                        "cantidad": cantidad,
+                        "unidad": unidad,
+                        "departamento": departamento,
+                        "duplicado": duplicado
+                    }
+                else:
+                    st.session_state.pop("producto_pendiente", None)
+                    product_id = add_product(conn, nombre.strip(), cantidad, unidad, departamento)
+                    st.success(f"✅ Producto '{nombre}' añadido con éxito al departamento {departamento} (ID: {product_id}).")
+                    st.rerun()
         except sqlite3.Error as e:
             st.error(f"❌ Error en base de datos: {e}")
         except Exception as e:
@@ -316,6 +609,49 @@ if submitted:
     else:
         st.error("⚠️ El nombre del producto no puede estar vacío.")
 
+# Confirmación cuando el producto parece duplicado de uno existente
+if "producto_pendiente" in st.session_state:
+    pendiente = st.session_state["producto_pendiente"]
+    dup_id, dup_nombre, dup_cantidad = pendiente["duplicado"]
+    
+    st.warning(
+        f"⚠️ Ya existe '{dup_nombre}' (ID: {dup_id}) en {pendiente['departamento']} con "
+        f"{dup_cantidad} {pendiente['unidad']}. Puedes sumar {pendiente['cantidad']} a su cantidad "
+        f"en lugar de crear '{pendiente['nombre']}' como un producto nuevo."
+    )
+    
+    col_pend1, col_pend2, col_pend3 = st.columns(3)
+    
+    with col_pend1:
+        if st.button(f"➕ Sumar a '{dup_nombre}'", type="primary", use_container_width=True,
+                     key="sumar_pendiente"):
+            # Releer el existente: su cantidad puede haber cambiado desde el aviso
+            existente = buscar_duplicado(conn, pendiente["nombre"], pendiente["departamento"],
+                                         pendiente["unidad"])
+            if existente and update_product(conn, existente[0], (existente[2] or 0) + pendiente["cantidad"]):
+                del st.session_state["producto_pendiente"]
+                st.success(f"✅ Cantidad de '{existente[1]}' actualizada.")
+                st.rerun()
+            else:
+                st.error("❌ El producto existente ya no está disponible.")
+    
+    with col_pend2:
+        if st.button("💾 Guardar de todos modos", use_container_width=True,
+                     key="guardar_pendiente"):
+            try:
+                product_id = add_product(conn, pendiente["nombre"], pendiente["cantidad"],
+                                         pendiente["unidad"], pendiente["departamento"])
+                del st.session_state["producto_pendiente"]
+                st.success(f"✅ Producto '{pendiente['nombre']}' añadido con éxito al departamento {pendiente['departamento']} (ID: {product_id}).")
+                st.rerun()
+            except sqlite3.Error as e:
+                st.error(f"❌ Error en base de datos: {e}")
+    
+    with col_pend3:
+        if st.button("❌ Cancelar", use_container_width=True, key="cancelar_pendiente"):
+            del st.session_state["producto_pendiente"]
+            st.rerun()
+
 # =================================================================
 # SECCIÓN: INVENTARIO ACTUAL
 # =================================================================
@@ -491,6 +827,103 @@ else:
                             if st.button("❌ Cancelar", use_container_width=True):
                                 st.info("Eliminación cancelada.")
 
+# =================================================================
+# SECCIÓN: DETECCIÓN DE DUPLICADOS
+# =================================================================
+st.divider()
+st.header("🧹 Detección de Duplicados")
+
+with st.expander("Buscar y fusionar productos duplicados", expanded=False):
+    st.write("Busca productos con nombres iguales o muy parecidos en el mismo departamento y unidad de medida:")
+    
+    umbral_similitud = st.slider(
+        "Similitud mínima:", min_value=0.5, max_value=1.0, value=0.7, step=0.05,
+        help="1.0 solo detecta nombres idénticos tras normalizar"
+    )
+    
+    if st.button("🔍 Buscar duplicados"):
+        barra_progreso = st.progress(0.0, text="Buscando duplicados...")
+        st.session_state["grupos_duplicados"] = buscar_duplicados(
+            conn, umbral_similitud,
+            progreso=lambda fraccion: barra_progreso.progress(fraccion, text="Buscando duplicados...")
+        )
+        barra_progreso.empty()
+    
+    grupos_duplicados = st.session_state.get("grupos_duplicados")
+    
+    if grupos_duplicados is not None:
+        if not grupos_duplicados:
+            st.success("✅ No se encontraron productos duplicados.")
+        else:
+            st.info(f"Quedan {len(grupos_duplicados)} grupos de posibles duplicados por revisar.")
+            
+            # Mostrar como máximo 50 grupos para no saturar la página; al fusionar
+            # o descartar un grupo se muestra el siguiente
+            for ids_grupo in grupos_duplicados[:50]:
+                # Claves de widgets según los IDs del grupo, no su posición en la lista
+                clave_grupo = "_".join(map(str, ids_grupo))
+                marcadores = ", ".join("?" for _ in ids_grupo)
+                grupo_df = pd.read_sql_query(
+                    f"""
+                        SELECT id, nombre, cantidad, unidad_medida, departamento
+                        FROM productos WHERE id IN ({marcadores}) ORDER BY id
+                    """,
+                    conn, params=ids_grupo
+                )
+                if len(grupo_df) < 2:
+                    continue
+                
+                st.dataframe(grupo_df, use_container_width=True, hide_index=True)
+                
+                col_dup1, col_dup2 = st.columns([2, 1])
+                
+                def etiqueta_producto(i, df=grupo_df):
+                    return f"ID {i}: {df.loc[df['id'] == i, 'nombre'].iloc[0]}"
+                
+                with col_dup1:
+                    id_conservar = st.selectbox(
+                        "Producto a conservar:",
+                        grupo_df['id'].tolist(),
+                        format_func=etiqueta_producto,
+                        key=f"dup_conservar_{clave_grupo}"
+                    )
+                    
+                    # El usuario elige qué filas fusionar: la similitud es transitiva
+                    # dentro del grupo y la fusión no se puede deshacer
+                    ids_fusionar = st.multiselect(
+                        "Productos a fusionar en el conservado:",
+                        [i for i in grupo_df['id'].tolist() if i != id_conservar],
+                        format_func=etiqueta_producto,
+                        key=f"dup_fusionar_ids_{clave_grupo}"
+                    )
+                
+                with col_dup2:
+                    st.write("")  # Espacio
+                    if st.button("🔗 Fusionar", key=f"dup_fusionar_{clave_grupo}", use_container_width=True,
+                                 disabled=not ids_fusionar):
+                        cantidad_final = fusionar_productos(conn, int(id_conservar), [int(i) for i in ids_fusionar])
+                        
+                        if cantidad_final is None:
+                            # El producto a conservar se eliminó o fusionó tras la búsqueda
+                            st.error(f"❌ El producto ID {id_conservar} ya no existe. Vuelve a buscar duplicados.")
+                        else:
+                            # Quitar del grupo los productos absorbidos
+                            restantes = [i for i in ids_grupo if i not in ids_fusionar]
+                            st.session_state["grupos_duplicados"] = [
+                                restantes if g == ids_grupo else g
+                                for g in grupos_duplicados
+                                if g != ids_grupo or len(restantes) > 1
+                            ]
+                            st.success(f"✅ Productos fusionados en ID {id_conservar} con {cantidad_final} unidades.")
+                            st.rerun()
+                    
+                    # Descartar falsos positivos para que no oculten los grupos siguientes
+                    if st.button("🙈 Descartar grupo", key=f"dup_descartar_{clave_grupo}", use_container_width=True):
+                        st.session_state["grupos_duplicados"] = [g for g in grupos_duplicados if g != ids_grupo]
+                        st.rerun()
+                
+                st.divider()
+
 # =================================================================
 # SECCIÓN: VISTA POR DEPARTAMENTOS
 # =================================================================
@@ -631,6 +1064,7 @@ with st.expander("ℹ️ Instrucciones de uso e información", expanded=False):
     
     ### 💡 Consejos:
     - Usa nombres descriptivos y consistentes
+    - Revisa periódicamente la detección de duplicados y fusiona los repetidos
     - Actualiza las cantidades regularmente
     - Exporta copias de seguridad periódicamente
     - Usa el historial para trackear movimientos